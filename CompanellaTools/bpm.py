@@ -1,12 +1,29 @@
 #!/usr/bin/env python3
 import argparse
+import hashlib
 import json
+import os
 import sys
-from collections import deque
 
 import librosa
 import numpy as np
-import scipy.ndimage
+import scipy.fft
+import scipy.stats
+import soundfile
+import soxr
+from numba import njit, prange
+
+# The @njit(cache=True) kernels compile on first use and are cached on disk.
+# In the frozen bpm.exe there is no .py file next to the code, so numba uses
+# its user-wide cache (%LOCALAPPDATA%\numba\numba\Cache), keyed by the exe's
+# mtime and size and by the working directory (BpmAnalyzer runs from the
+# exe's folder). The first run after each install therefore pays a few
+# seconds of compile time on top of librosa's own kernels; NUMBA_CACHE_DIR
+# is not honoured there.
+
+# librosa < 0.11 defaults to numpy.fft, which ignores scipy.fft.set_workers.
+if librosa.get_fftlib() is not scipy.fft:
+    librosa.set_fftlib(scipy.fft)
 
 
 def parse_arguments():
@@ -27,10 +44,23 @@ def parse_arguments():
     p.add_argument("-o", "--output", type=str, default=None, help="Write output to file")
     p.add_argument("-j", "--json", action="store_true", help="Output JSON")
     p.add_argument("-a", "--average", action="store_true", help="Show average BPM across timing points")
+    p.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Cache decoded 44.1 kHz audio here to skip decoding on repeat runs",
+    )
 
     p.add_argument("--bpm-hint", type=float, default=None, help="Expected BPM hint (e.g. 180)")
     p.add_argument("--percussion", action="store_true", help="Use HPSS percussive component")
     p.add_argument("--tightness", type=float, default=80, help="librosa beat_track tightness (default 80)")
+    p.add_argument("--gpu", action="store_true", help="Compute spectrograms on a CUDA GPU via torch (falls back to CPU)")
+    p.add_argument(
+        "--block-seconds",
+        type=float,
+        default=600.0,
+        help="Analyse audio longer than this in blocks of this length (min 2) to bound memory; 0 disables (default 600)",
+    )
 
     # Onset/grid matching
     p.add_argument("--hop-length", type=int, default=256, help="Hop length for onset envelope (default 256)")
@@ -59,6 +89,11 @@ def parse_arguments():
     )
 
     # Phase (beat-zero alignment)
+    p.add_argument(
+        "--no-offbeat",
+        action="store_true",
+        help="Skip the off-beat phase search and keep the beat tracker's anchor",
+    )
     p.add_argument(
         "--phase-divisions",
         type=int,
@@ -76,44 +111,282 @@ def parse_arguments():
     p.add_argument("--min-gap-ms", type=float, default=600.0, help="Min time between timing points (ms) (default 600)")
     p.add_argument("--max-points", type=int, default=200, help="Hard cap timing points (default 200)")
 
+    # Sent by BpmAnalyzer; Mode A has no separate stabilization pass, so these are no-ops
+    p.add_argument("--no-stabilize", action="store_true", help="Accepted for compatibility; ignored")
+    p.add_argument("--bpm-tolerance", type=float, default=2.0, help="Accepted for compatibility; ignored")
+
     return p.parse_args()
 
 
-def load_audio(path: str):
+def audio_cache_path(path: str, cache_dir: str):
+    # Keyed on path, size and mtime so an edited source file misses the cache.
+    st = os.stat(path)
+    key = f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}"
+    return os.path.join(cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".npy")
+
+
+def load_audio_cache(cache_path: str):
+    # A truncated or corrupt entry counts as a miss, so it gets re-decoded and overwritten.
     try:
-        y, sr = librosa.load(path, sr=44100, mono=True)
+        y = np.load(cache_path, mmap_mode="r")
+    except (OSError, ValueError, EOFError) as e:
+        print(f"Warning: ignoring unreadable audio cache: {e}", file=sys.stderr)
+        return None
+    if y.ndim != 1 or y.size == 0:
+        return None
+    return y
+
+
+def save_audio_cache(cache_path: str, y):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, y)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Warning: could not write audio cache: {e}", file=sys.stderr)
+
+
+def decode_audio(path: str, sr: int):
+    """
+    Decode to mono float32 at sr via libsndfile + soxr.
+    Falls back to librosa.load for formats libsndfile cannot read.
+    """
+    try:
+        y, sr_in = soundfile.read(path, dtype="float32", always_2d=False)
+    except RuntimeError:
+        y, _ = librosa.load(path, sr=sr, mono=True, dtype=np.float32)
+        return y
+
+    if y.ndim > 1:
+        y = y.mean(axis=1)
+    if sr_in != sr:
+        n_samples = int(np.ceil(len(y) * float(sr) / sr_in))
+        y = librosa.util.fix_length(soxr.resample(y, sr_in, sr, quality="HQ"), size=n_samples)
+    return y
+
+
+def load_audio(path: str, cache_dir=None):
+    try:
+        cache_path = audio_cache_path(path, cache_dir) if cache_dir else None
+        if cache_path and os.path.exists(cache_path):
+            y = load_audio_cache(cache_path)
+            if y is not None:
+                return y, 44100
+
+        sr = 44100
+        y = decode_audio(path, sr)
         if y.size == 0:
             raise ValueError("Empty audio.")
+        if cache_path:
+            save_audio_cache(cache_path, y)
         return y, sr
     except Exception as e:
         print(f"Error loading audio: {e}", file=sys.stderr)
         sys.exit(1)
 
 
-def compute_onset_env(y, sr, hop_length):
-    onset_spectral = librosa.onset.onset_strength(
-        y=y,
-        sr=sr,
+def compute_spectrograms_gpu(y, sr, hop_length):
+    """
+    CUDA version of the STFT + mel projection in compute_spectrograms.
+    Returns (S, M), or None when torch or a CUDA device is unavailable.
+    """
+    try:
+        import torch
+    except ImportError:
+        return None
+    if not torch.cuda.is_available():
+        return None
+
+    mel_basis = librosa.filters.mel(sr=sr, n_fft=2048, n_mels=128, fmax=8000, dtype=np.float32)
+    window = torch.hann_window(2048, periodic=True, device="cuda")
+    S = torch.stft(
+        torch.as_tensor(y, dtype=torch.float32, device="cuda"),
+        n_fft=2048,
         hop_length=hop_length,
-        aggregate=np.median,
-        fmax=8000,
-        n_mels=128,
-    )
-    S = np.abs(librosa.stft(y, n_fft=2048, hop_length=hop_length))
-    onset_energy = librosa.onset.onset_strength(S=S, sr=sr, hop_length=hop_length, aggregate=np.mean)
+        window=window,
+        center=True,
+        pad_mode="constant",
+        return_complex=True,
+    ).abs()
+    M = torch.as_tensor(mel_basis, device="cuda") @ (S**2)
+    return S.cpu().numpy(), M.cpu().numpy()
+
+
+def compute_spectrograms(y, sr, hop_length, use_gpu=False):
+    """
+    Magnitude STFT (n_fft 2048) and mel power spectrogram (128 bands, fmax 8000).
+    """
+    if use_gpu:
+        spectrograms = compute_spectrograms_gpu(y, sr, hop_length)
+        if spectrograms is not None:
+            return spectrograms
+        print("GPU requested but torch/CUDA is unavailable, using CPU.", file=sys.stderr)
+
+    with scipy.fft.set_workers(-1):
+        S = np.abs(librosa.stft(y, n_fft=2048, hop_length=hop_length))
+    mel_basis = librosa.filters.mel(sr=sr, n_fft=2048, n_mels=128, fmax=8000, dtype=np.float32)
+    M = mel_basis @ (S**2)
+    return S, M
+
+
+@njit(parallel=True, cache=True)
+def onset_flux(S, pad, use_median):
+    """
+    Half-wave rectified first difference of S along time, aggregated
+    over bins (median or mean), shifted right by pad frames.
+    Equivalent to librosa.onset.onset_strength(S=S, lag=1, max_size=1).
+    """
+    n_bins, n_frames = S.shape
+    out = np.zeros(n_frames, dtype=S.dtype)
+    for t in prange(1, n_frames - pad + 1):
+        d = np.empty(n_bins, dtype=S.dtype)
+        for k in range(n_bins):
+            d[k] = max(S[k, t] - S[k, t - 1], 0.0)
+        out[t + pad - 1] = np.median(d) if use_median else np.mean(d)
+    return out
+
+
+def median3(x):
+    """
+    3-tap running median via min/max; edges are kept, which matches
+    scipy.ndimage.median_filter(x, size=3) in its default reflect mode.
+    """
+    a, b, c = x[:-2], x[1:-1], x[2:]
+    out = x.copy()
+    out[1:-1] = np.maximum(np.minimum(a, b), np.minimum(np.maximum(a, b), c))
+    return out
+
+
+def percussive_component(y):
+    try:
+        # Coarser than the hpss() defaults and percussive-only (no harmonic
+        # iSTFT): tuned for onset/beat tracking, not for rendering audio.
+        return librosa.effects.percussive(y, margin=1.0, kernel_size=17, n_fft=1024, hop_length=256)
+    except Exception:
+        return y
+
+
+def compute_onset_strengths(y, sr, hop_length, use_gpu=False):
+    """
+    Un-normalized spectral (log-mel, median) and energy (magnitude, mean)
+    onset strengths of y.
+    """
+    # One STFT feeds both envelopes; the log-mel input is exactly what
+    # onset_strength(y=...) would otherwise build from a second STFT.
+    S, M = compute_spectrograms(y, sr, hop_length, use_gpu)
 
+    # onset_strength pads lag + n_fft // (2 * hop_length) frames to centre the envelope
+    pad = 1 + 2048 // (2 * hop_length)
+    onset_spectral = onset_flux(librosa.power_to_db(M), pad, True)
+    onset_energy = onset_flux(S, pad, False)
+    return onset_spectral, onset_energy
+
+
+def combine_onset_strengths(onset_spectral, onset_energy):
     onset_spectral = onset_spectral / (np.max(onset_spectral) + 1e-12)
     onset_energy = onset_energy / (np.max(onset_energy) + 1e-12)
-    env = 0.75 * onset_spectral + 0.25 * onset_energy
-    env = scipy.ndimage.median_filter(env, size=3)
+    # The whole signal path stays float32; only beat times go float64.
+    env = (0.75 * onset_spectral + 0.25 * onset_energy).astype(np.float32, copy=False)
+    env = median3(env)
     return env
 
 
-def create_tempo_prior(bpm_hint, spread=20.0):
-    def prior(bpm):
-        return np.exp(-0.5 * ((bpm - bpm_hint) / spread) ** 2)
+def compute_onset_env(y, sr, hop_length, use_gpu=False):
+    return combine_onset_strengths(*compute_onset_strengths(y, sr, hop_length, use_gpu))
+
+
+def should_stream(path: str, block_seconds: float):
+    if block_seconds <= 0:
+        return False
+    try:
+        return soundfile.info(path).duration > block_seconds
+    except RuntimeError:
+        return False
+
 
-    return prior
+def iter_audio_blocks(path: str, sr: int, block: int, overlap: int):
+    """
+    Decode path to mono float32 at sr and yield it as (y, lead, is_last) for
+    consecutive spans of `block` samples. Each y carries up to `overlap`
+    samples of context on both sides; lead is the context before the span.
+    The last y runs to the end of the file.
+    """
+    # More context than span would push the first slice start below zero
+    overlap = min(overlap, block)
+    with soundfile.SoundFile(path) as f:
+        resampler = None
+        if f.samplerate != sr:
+            resampler = soxr.ResampleStream(f.samplerate, sr, 1, dtype="float32", quality="HQ")
+
+        buf = np.zeros(0, dtype=np.float32)
+        lead = 0
+        for chunk in f.blocks(blocksize=block, dtype="float32", always_2d=True):
+            y = chunk.mean(axis=1)
+            if resampler is not None:
+                y = resampler.resample_chunk(y)
+            buf = np.concatenate([buf, y])
+            while len(buf) >= lead + block + overlap:
+                yield buf[: lead + block + overlap], lead, False
+                buf = buf[lead + block - overlap :]
+                lead = overlap
+
+        if resampler is not None:
+            buf = np.concatenate([buf, resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)])
+
+        while len(buf) - lead > block:
+            yield buf[: lead + block + overlap], lead, False
+            buf = buf[lead + block - overlap :]
+            lead = overlap
+        yield buf, lead, True
+
+
+def compute_onset_env_streamed(
+    path: str,
+    sr: int,
+    hop_length: int,
+    use_percussion=False,
+    use_gpu=False,
+    block_seconds=600.0,
+    overlap_seconds=2.0,
+):
+    """
+    Same envelope as compute_onset_env, but the file is decoded and analysed
+    in overlapping blocks so peak memory scales with the block, not the track.
+    Block strengths are trimmed to their own span and joined before the
+    global normalization. Returns (onset_env, duration_s).
+    """
+    # Whole hops, so block frames line up with frames of the full signal
+    block = max(1, int(block_seconds * sr) // hop_length) * hop_length
+    overlap = max(1, int(overlap_seconds * sr) // hop_length) * hop_length
+    # Shorter blocks would get less than the full overlap of context
+    block = max(block, overlap)
+
+    spectral_parts = []
+    energy_parts = []
+    n_samples = 0
+    for y, lead, is_last in iter_audio_blocks(path, sr, block, overlap):
+        if use_percussion:
+            y = percussive_component(y)
+        onset_spectral, onset_energy = compute_onset_strengths(y, sr, hop_length, use_gpu)
+
+        start = lead // hop_length
+        stop = None if is_last else start + block // hop_length
+        spectral_parts.append(onset_spectral[start:stop])
+        energy_parts.append(onset_energy[start:stop])
+        n_samples += len(y) - lead if is_last else block
+
+    if n_samples == 0:
+        raise ValueError("Empty audio.")
+    env = combine_onset_strengths(np.concatenate(spectral_parts), np.concatenate(energy_parts))
+    return env, n_samples / sr
+
+
+def create_tempo_prior(bpm_hint, spread=20.0):
+    # librosa evaluates prior.logpdf once over its whole tempo grid, so a
+    # frozen distribution replaces a per-candidate Python callback.
+    return scipy.stats.norm(loc=bpm_hint, scale=spread)
 
 
 def estimate_initial_bpm(onset_env, sr, hop_length, bpm_hint):
@@ -123,65 +396,197 @@ def estimate_initial_bpm(onset_env, sr, hop_length, bpm_hint):
     return float(librosa.feature.tempo(onset_envelope=onset_env, sr=sr, hop_length=hop_length)[0])
 
 
+@njit(cache=True)
+def track_beats(onset_env, frames_per_beat, tightness):
+    """
+    Ellis dynamic-programming beat tracker for a fixed tempo.
+    Same algorithm as librosa.beat.beat_track(bpm=..., trim=False).
+    frames_per_beat is the (rounded) beat period in onset frames.
+    Returns beat frames in ascending order.
+    """
+    n = len(onset_env)
+    period = int(frames_per_beat)
+
+    # Normalize by standard deviation (ddof=1)
+    mean = np.mean(onset_env)
+    var = 0.0
+    for i in range(n):
+        var += (onset_env[i] - mean) ** 2
+    onsets = onset_env / (np.sqrt(var / max(1, n - 1)) + 1e-30)
+
+    # Local score: onsets smoothed with a Gaussian one beat wide. Like librosa's
+    # same-mode loop, k stops short of i + period, so onsets[0] is never read.
+    window = np.exp(-0.5 * (np.arange(-period, period + 1) * 32.0 / frames_per_beat) ** 2)
+    localscore = np.zeros(n)
+    for i in range(n):
+        for k in range(max(0, i + period - n + 1), min(i + period, 2 * period + 1)):
+            localscore[i] += window[k] * onsets[i + period - k]
+
+    # DP: best predecessor between half and twice a beat period back
+    backlink = np.full(n, -1, dtype=np.int64)
+    cumscore = np.zeros(n)
+    score_thresh = 0.01 * localscore.max()
+    first_beat = True
+    log_period = np.log(frames_per_beat)
+    for i in range(n):
+        best_score = -np.inf
+        beat_location = -1
+        for loc in range(i - int(np.round(frames_per_beat / 2)), i - 2 * period - 1, -1):
+            if loc < 0:
+                break
+            score = cumscore[loc] - tightness * (np.log(i - loc) - log_period) ** 2
+            if score > best_score:
+                best_score = score
+                beat_location = loc
+
+        cumscore[i] = localscore[i] + best_score if beat_location >= 0 else localscore[i]
+
+        if first_beat and localscore[i] < score_thresh:
+            backlink[i] = -1
+        else:
+            backlink[i] = beat_location
+            first_beat = False
+
+    # Last beat: last local max of cumscore above half the median local max.
+    # As in librosa.util.localmax, frame 0 is never a local max.
+    is_max = np.zeros(n, dtype=np.bool_)
+    if n > 1:
+        for i in range(1, n - 1):
+            is_max[i] = cumscore[i] > cumscore[i - 1] and cumscore[i] >= cumscore[i + 1]
+        is_max[n - 1] = cumscore[n - 1] > cumscore[n - 2]
+    threshold = 0.5 * np.median(cumscore[is_max]) if is_max.any() else 0.0
+    tail = n - 1
+    for i in range(n - 1, -1, -1):
+        if is_max[i] and cumscore[i] >= threshold:
+            tail = i
+            break
+
+    # Backtrack
+    beats = np.zeros(n, dtype=np.bool_)
+    i = tail
+    while i >= 0:
+        beats[i] = True
+        i = backlink[i]
+
+    # Drop beats on silent leading/trailing frames
+    i = 0
+    while i < n and localscore[i] <= 0.0:
+        beats[i] = False
+        i += 1
+    i = n - 1
+    while i >= 0 and localscore[i] <= 0.0:
+        beats[i] = False
+        i -= 1
+
+    return np.flatnonzero(beats)
+
+
 def estimate_initial_anchor(onset_env, sr, hop_length, bpm, tightness):
-    # Use beat_track ONLY to seed a starting time anchor (t0).
-    _, beat_frames = librosa.beat.beat_track(
-        onset_envelope=onset_env,
-        sr=sr,
-        hop_length=hop_length,
-        bpm=bpm,
-        tightness=tightness,
-        trim=False,
-    )
-    if beat_frames is None or len(beat_frames) < 2:
+    # Use beat tracking ONLY to seed a starting time anchor (t0).
+    if not onset_env.any():
+        return 0.0
+    frames_per_beat = float(np.round(sr / hop_length * 60.0 / bpm))
+    beat_frames = track_beats(onset_env, frames_per_beat, float(tightness))
+    if len(beat_frames) < 2:
         return 0.0
-    beat_times = librosa.frames_to_time(beat_frames, sr=sr, hop_length=hop_length)
-    return float(beat_times[0])
+    return float(beat_frames[0]) * hop_length / sr
 
 
+@njit(cache=True)
 def find_nearest_onset(onset_times, idx_hint, t, window_s):
     """
     onset_times must be sorted.
     idx_hint is the previous onset index (monotonic scan).
-    Returns (matched_time or None, new_idx_hint)
+    Returns (matched_index or -1, new_idx_hint)
     """
     n = len(onset_times)
     if n == 0:
-        return None, idx_hint
+        return -1, idx_hint
 
     i = max(0, idx_hint)
     while i + 1 < n and onset_times[i] < t - window_s:
         i += 1
 
-    candidates = []
-    for j in (i - 1, i, i + 1, i + 2):
+    best_j = -1
+    best_dt = window_s
+    for j in range(i - 1, i + 3):
         if 0 <= j < n:
             dt = abs(onset_times[j] - t)
-            if dt <= window_s:
-                candidates.append((dt, j))
+            if dt <= window_s and (best_j < 0 or dt < best_dt):
+                best_j = j
+                best_dt = dt
+
+    if best_j < 0:
+        return -1, i
+    return best_j, best_j
+
+
+def match_onsets(onset_times, beat_times, window_s):
+    """
+    Vectorized nearest-onset lookup for a whole beat grid.
+    onset_times must be sorted; ties go to the earlier onset.
+    beat_times may have any shape.
+    Returns (errors_s, matched) where errors_s = onset - beat.
+    """
+    n = len(onset_times)
+    if n == 0:
+        return np.zeros(np.shape(beat_times)), np.zeros(np.shape(beat_times), dtype=bool)
+
+    pos = np.searchsorted(onset_times, beat_times)
+    left = onset_times[np.clip(pos - 1, 0, n - 1)]
+    right = onset_times[np.clip(pos, 0, n - 1)]
+    use_left = (pos > 0) & ((pos == n) | (np.abs(left - beat_times) <= np.abs(right - beat_times)))
+
+    errors = np.where(use_left, left, right) - beat_times
+    return errors, np.abs(errors) <= window_s
+
 
-    if not candidates:
-        return None, i
+@njit(cache=True)
+def sorted_insert(buf, n, value):
+    """
+    Insert value into the sorted prefix buf[:n] (buf must have room for n + 1).
+    """
+    pos = np.searchsorted(buf[:n], value)
+    buf[pos + 1 : n + 1] = buf[pos:n].copy()
+    buf[pos] = value
+
+
+@njit(cache=True)
+def sorted_remove(buf, n, value):
+    """
+    Remove one occurrence of value from the sorted prefix buf[:n].
+    """
+    pos = np.searchsorted(buf[:n], value)
+    buf[pos : n - 1] = buf[pos + 1 : n].copy()
 
-    _, best_j = min(candidates, key=lambda x: x[0])
-    return float(onset_times[best_j]), best_j
+
+@njit(cache=True)
+def sorted_median(buf, n):
+    """
+    Median of the sorted prefix buf[:n] (same convention as np.median).
+    """
+    mid = n // 2
+    if n % 2 == 1:
+        return buf[mid]
+    return 0.5 * (buf[mid - 1] + buf[mid])
 
 
-def robust_slope_s_per_beat(beat_indices, errors_s):
+@njit(cache=True)
+def robust_slope_s_per_beat(n, sum_x, sum_y, sum_xx, sum_xy, median_index, median_error):
     """
-    Slope estimate of error vs beat index.
+    Slope estimate of error vs beat index, centered on the medians.
+    Takes running window sums (x = beat index, y = error) so the caller
+    can update them in O(1) per beat.
     Returns slope in seconds/beat.
     """
-    x = np.asarray(beat_indices, dtype=float)
-    y = np.asarray(errors_s, dtype=float)
-    if x.size < 6:
+    if n < 6:
         return 0.0
-    x0 = x - np.median(x)
-    y0 = y - np.median(y)
-    denom = np.dot(x0, x0)
-    if denom <= 1e-12:
+    # sum((x - mx)^2) and sum((x - mx) * (y - my)) expanded over raw sums
+    sxx = sum_xx - 2.0 * median_index * sum_x + n * median_index * median_index
+    sxy = sum_xy - median_error * sum_x - median_index * sum_y + n * median_index * median_error
+    if sxx <= 1e-12:
         return 0.0
-    return float(np.dot(x0, y0) / denom)
+    return sxy / sxx
 
 
 def choose_best_phase(t0, interval, onset_times, match_window_s, search_seconds, phase_divisions):
@@ -202,115 +607,69 @@ def choose_best_phase(t0, interval, onset_times, match_window_s, search_seconds,
     if ot.size == 0:
         return t0
 
-    best_t0 = t0
-    best_matches = -1
-    best_med_abs_err = float("inf")
-
-    for k in range(phase_divisions):
-        cand_t0 = t0 + (k / phase_divisions) * interval
-        onset_idx_hint = 0
-        beat_idx = 0
-        t = cand_t0
-
-        errs = []
-        matches = 0
-
-        while t <= cand_t0 + search_seconds:
-            m, onset_idx_hint = find_nearest_onset(ot, onset_idx_hint, t, match_window_s)
-            if m is not None:
-                matches += 1
-                errs.append(m - t)
-            beat_idx += 1
-            t = cand_t0 + beat_idx * interval
+    # One row of beat times per candidate phase
+    cand_t0 = t0 + (np.arange(phase_divisions) / phase_divisions) * interval
+    beat_offsets = np.arange(int(search_seconds // interval) + 2) * interval
+    grid = cand_t0[:, None] + beat_offsets[None, :]
+    in_range = grid <= (cand_t0 + search_seconds)[:, None]
 
-        if matches == 0:
-            continue
-
-        med_abs_err = float(np.median(np.abs(errs))) if errs else float("inf")
-
-        if (matches > best_matches) or (matches == best_matches and med_abs_err < best_med_abs_err):
-            best_matches = matches
-            best_med_abs_err = med_abs_err
-            best_t0 = cand_t0
-
-    return best_t0
+    errs, matched = match_onsets(ot, grid, match_window_s)
+    matched &= in_range
+    matches = np.count_nonzero(matched, axis=1)
 
+    best_matches = matches.max()
+    if best_matches == 0:
+        return t0
 
-def analyze_mode_a(
-    y,
-    sr,
-    bpm_hint=None,
-    use_percussion=False,
-    tightness=80,
-    hop_length=256,
-    match_window_ms=40.0,
-    decision_window=24,
-    min_matches=14,
-    persist=8,
-    offset_threshold_ms=18.0,
-    drift_slope_ms_per_beat=1.2,
-    bpm_min_change=0.35,
-    phase_divisions=4,
-    phase_search_seconds=18.0,
-    min_gap_ms=600.0,
-    max_points=200,
+    # First candidate with the most matches, then the lowest median |error|
+    cands = np.flatnonzero(matches == best_matches)
+    abs_errs = np.where(matched[cands], np.abs(errs[cands]), np.nan)
+    med_abs_err = np.nanmedian(abs_errs, axis=1)
+
+    return float(cand_t0[cands[np.argmin(med_abs_err)]])
+
+
+@njit(cache=True)
+def track_timing_points(
+    onset_times,
+    t0,
+    interval,
+    bpm,
+    duration,
+    window_s,
+    decision_window,
+    min_matches,
+    persist,
+    offset_threshold_ms,
+    drift_slope_ms_per_beat,
+    bpm_min_change,
+    min_gap_ms,
+    max_points,
 ):
-    if use_percussion:
-        try:
-            y_h, y_p = librosa.effects.hpss(y)
-            y_use = y_p
-        except Exception:
-            y_use = y
-    else:
-        y_use = y
-
-    onset_env = compute_onset_env(y_use, sr, hop_length)
-
-    onset_frames = librosa.onset.onset_detect(
-        onset_envelope=onset_env,
-        sr=sr,
-        hop_length=hop_length,
-        backtrack=False,
-        units="frames",
-    )
-    onset_times = librosa.frames_to_time(onset_frames, sr=sr, hop_length=hop_length)
-    onset_times = np.asarray(onset_times, dtype=float)
-    onset_times.sort()
-
-    bpm = estimate_initial_bpm(onset_env, sr, hop_length, bpm_hint)
-    if not np.isfinite(bpm) or bpm <= 1e-6:
-        bpm = 120.0
-
-    interval = 60.0 / bpm
-    t0 = estimate_initial_anchor(onset_env, sr, hop_length, bpm, tightness)
-
-    window_s = match_window_ms / 1000.0
-
-    # Snap anchor once if close (safe init)
-    if onset_times.size > 0:
-        j0 = int(np.argmin(np.abs(onset_times - t0)))
-        if abs(onset_times[j0] - t0) <= window_s * 2.5:
-            t0 = float(onset_times[j0])
-
-    # Phase selection (quarter-beat by default)
-    t0 = choose_best_phase(
-        t0=t0,
-        interval=interval,
-        onset_times=onset_times,
-        match_window_s=window_s,
-        search_seconds=phase_search_seconds,
-        phase_divisions=phase_divisions,
-    )
-
-    duration = len(y) / sr
-
-    # Timing points list of (time, bpm)
-    points = [(t0, float(bpm))]
+    """
+    Walk the beat grid and insert timing points on drift / phase jumps.
+    Returns (point_times, point_bpms, bpm).
+    """
+    # Timing points, preallocated up to the hard cap
+    point_times = np.empty(max(1, max_points))
+    point_bpms = np.empty(max(1, max_points))
+    point_times[0] = t0
+    point_bpms[0] = bpm
+    n_points = 1
     last_point_time = t0
 
-    # Rolling matched errors
-    err_q = deque(maxlen=max(8, int(decision_window)))
-    idx_q = deque(maxlen=max(8, int(decision_window)))
+    # Rolling matched errors (ring buffer; order is irrelevant for median/slope)
+    err_q = np.empty(decision_window)
+    idx_q = np.empty(decision_window)
+    # Same errors kept sorted, so the median is O(1) instead of a sort per beat
+    err_sorted = np.empty(decision_window)
+    q_head = 0
+    q_len = 0
+    # Running sums over the window for the slope (x = beat index, y = error)
+    sum_x = 0.0
+    sum_y = 0.0
+    sum_xx = 0.0
+    sum_xy = 0.0
 
     onset_idx_hint = 0
     eval_streak_offset = 0
@@ -323,27 +682,49 @@ def analyze_mode_a(
         beat_idx += 1
         t = t0 + beat_idx * interval
 
-    while t <= duration and len(points) < max_points:
-        matched, onset_idx_hint = find_nearest_onset(onset_times, onset_idx_hint, t, window_s)
-
-        if matched is not None:
+    while t <= duration and n_points < max_points:
+        j, onset_idx_hint = find_nearest_onset(onset_times, onset_idx_hint, t, window_s)
+        matched = onset_times[j] if j >= 0 else 0.0
+
+        if j >= 0:
+            if q_len == decision_window:
+                old_x = idx_q[q_head]
+                old_y = err_q[q_head]
+                sorted_remove(err_sorted, q_len, old_y)
+                sum_x -= old_x
+                sum_y -= old_y
+                sum_xx -= old_x * old_x
+                sum_xy -= old_x * old_y
+                q_len -= 1
             e = matched - t
-            err_q.append(float(e))
-            idx_q.append(int(beat_idx))
-
-        if len(err_q) >= min_matches:
-            errors = np.asarray(err_q, dtype=float)
-            indices = np.asarray(idx_q, dtype=int)
-
-            med_e = float(np.median(errors))
-            slope = robust_slope_s_per_beat(indices, errors)  # s/beat
+            sorted_insert(err_sorted, q_len, e)
+            sum_x += beat_idx
+            sum_y += e
+            sum_xx += beat_idx * beat_idx
+            sum_xy += beat_idx * e
+            err_q[q_head] = e
+            idx_q[q_head] = beat_idx
+            q_head = (q_head + 1) % decision_window
+            q_len += 1
+
+        if q_len >= min_matches:
+            # Beat indices enter in increasing order, so their median is the
+            # middle of the ring buffer in arrival order.
+            q_start = (q_head - q_len) % decision_window
+            mid = q_len // 2
+            med_idx = idx_q[(q_start + mid) % decision_window]
+            if q_len % 2 == 0:
+                med_idx = 0.5 * (idx_q[(q_start + mid - 1) % decision_window] + med_idx)
+
+            med_e = sorted_median(err_sorted, q_len)
+            slope = robust_slope_s_per_beat(q_len, sum_x, sum_y, sum_xx, sum_xy, med_idx, med_e)  # s/beat
 
             med_e_ms = med_e * 1000.0
             slope_ms = slope * 1000.0
 
-            is_drift = abs(slope_ms) >= float(drift_slope_ms_per_beat)
-            is_jump = (abs(med_e_ms) >= float(offset_threshold_ms)) and (
-                abs(slope_ms) < float(drift_slope_ms_per_beat) * 0.6
+            is_drift = abs(slope_ms) >= drift_slope_ms_per_beat
+            is_jump = (abs(med_e_ms) >= offset_threshold_ms) and (
+                abs(slope_ms) < drift_slope_ms_per_beat * 0.6
             )
 
             eval_streak_drift = eval_streak_drift + 1 if is_drift else 0
@@ -354,72 +735,179 @@ def analyze_mode_a(
                 new_bpm = 60.0 / new_interval if new_interval > 1e-4 else bpm
 
                 if np.isfinite(new_bpm) and abs(new_bpm - bpm) >= bpm_min_change:
-                    anchor_time = matched if matched is not None else (t + med_e)
+                    anchor_time = matched if j >= 0 else (t + med_e)
                     if (anchor_time - last_point_time) * 1000.0 >= min_gap_ms:
-                        bpm = float(new_bpm)
+                        bpm = new_bpm
                         interval = 60.0 / bpm
-                        t0 = float(anchor_time) - beat_idx * interval
+                        t0 = anchor_time - beat_idx * interval
 
-                        points.append((float(anchor_time), float(bpm)))
-                        last_point_time = float(anchor_time)
+                        point_times[n_points] = anchor_time
+                        point_bpms[n_points] = bpm
+                        n_points += 1
+                        last_point_time = anchor_time
 
-                        err_q.clear()
-                        idx_q.clear()
+                        q_head = 0
+                        q_len = 0
+                        sum_x = sum_y = sum_xx = sum_xy = 0.0
                         eval_streak_drift = 0
                         eval_streak_offset = 0
 
             elif eval_streak_offset >= persist:
-                anchor_time = matched if matched is not None else (t + med_e)
+                anchor_time = matched if j >= 0 else (t + med_e)
                 if (anchor_time - last_point_time) * 1000.0 >= min_gap_ms:
-                    t0 = float(anchor_time) - beat_idx * interval
+                    t0 = anchor_time - beat_idx * interval
 
-                    points.append((float(anchor_time), float(bpm)))
-                    last_point_time = float(anchor_time)
+                    point_times[n_points] = anchor_time
+                    point_bpms[n_points] = bpm
+                    n_points += 1
+                    last_point_time = anchor_time
 
-                    err_q.clear()
-                    idx_q.clear()
+                    q_head = 0
+                    q_len = 0
+                    sum_x = sum_y = sum_xx = sum_xy = 0.0
                     eval_streak_drift = 0
                     eval_streak_offset = 0
 
         beat_idx += 1
         t = t0 + beat_idx * interval
 
-    return points, bpm
+    return point_times[:n_points], point_bpms[:n_points], bpm
 
 
-def format_text(points, show_average, tempo_seed):
+def analyze_mode_a(
+    onset_env,
+    sr,
+    duration,
+    bpm_hint=None,
+    tightness=80,
+    hop_length=256,
+    match_window_ms=40.0,
+    decision_window=24,
+    min_matches=14,
+    persist=8,
+    offset_threshold_ms=18.0,
+    drift_slope_ms_per_beat=1.2,
+    bpm_min_change=0.35,
+    detect_offbeats=True,
+    phase_divisions=4,
+    phase_search_seconds=18.0,
+    min_gap_ms=600.0,
+    max_points=200,
+):
+    onset_frames = librosa.onset.onset_detect(
+        onset_envelope=onset_env,
+        sr=sr,
+        hop_length=hop_length,
+        backtrack=False,
+        units="frames",
+    )
+    # onset_detect returns frames in ascending order, so no re-sort is needed
+    onset_times = onset_frames * hop_length / sr
+
+    bpm = estimate_initial_bpm(onset_env, sr, hop_length, bpm_hint)
+    if not np.isfinite(bpm) or bpm <= 1e-6:
+        bpm = 120.0
+
+    interval = 60.0 / bpm
+    t0 = estimate_initial_anchor(onset_env, sr, hop_length, bpm, tightness)
+
+    window_s = match_window_ms / 1000.0
+
+    # Snap anchor once if close (safe init). onset_times is sorted, so only
+    # the onsets either side of t0 can be the nearest one.
+    j0 = int(np.searchsorted(onset_times, t0))
+    candidates = onset_times[max(0, j0 - 1) : j0 + 1]
+    if candidates.size > 0:
+        nearest = float(candidates[np.argmin(np.abs(candidates - t0))])
+        if abs(nearest - t0) <= window_s * 2.5:
+            t0 = nearest
+
+    # Phase selection (quarter-beat by default)
+    if detect_offbeats:
+        t0 = choose_best_phase(
+            t0=t0,
+            interval=interval,
+            onset_times=onset_times,
+            match_window_s=window_s,
+            search_seconds=phase_search_seconds,
+            phase_divisions=phase_divisions,
+        )
+
+    point_times, point_bpms, bpm = track_timing_points(
+        onset_times,
+        t0,
+        interval,
+        float(bpm),
+        duration,
+        window_s,
+        max(8, int(decision_window)),
+        int(min_matches),
+        int(persist),
+        float(offset_threshold_ms),
+        float(drift_slope_ms_per_beat),
+        float(bpm_min_change),
+        float(min_gap_ms),
+        int(max_points),
+    )
+    return point_times, point_bpms, bpm
+
+
+def format_text(point_times, point_bpms, show_average, tempo_seed):
     lines = []
     lines.append("Time (s)     |  BPM")
     lines.append("-" * 26)
-    for t, bpm in points:
+    for t, bpm in zip(point_times.tolist(), point_bpms.tolist()):
         lines.append(f"{t:.3f}s     |  {bpm:.2f}")
-    if show_average and points:
-        avg = float(np.mean([b for _, b in points]))
+    if show_average and point_bpms.size:
+        avg = float(np.mean(point_bpms))
         lines.append("-" * 26)
         lines.append(f"Average BPM (timing points): {avg:.2f}")
         lines.append(f"Initial tempo seed: {float(tempo_seed):.2f}")
     return "\n".join(lines)
 
 
-def format_json(points, show_average, tempo_seed):
+def format_json(point_times, point_bpms, show_average, tempo_seed):
     out = {
-        "beats": [{"time": round(float(t), 4), "bpm": round(float(bpm), 2)} for t, bpm in points]
+        "beats": [
+            {"time": round(t, 4), "bpm": round(bpm, 2)}
+            for t, bpm in zip(point_times.tolist(), point_bpms.tolist())
+        ]
     }
-    if show_average and points:
-        out["average_bpm"] = round(float(np.mean([b for _, b in points])), 2)
+    if show_average and point_bpms.size:
+        out["average_bpm"] = round(float(np.mean(point_bpms)), 2)
         out["tempo_seed"] = round(float(tempo_seed), 2)
     return json.dumps(out, indent=2)
 
 
 def main():
     args = parse_arguments()
-    y, sr = load_audio(args.audio_file)
 
-    points, tempo_seed = analyze_mode_a(
-        y=y,
+    if should_stream(args.audio_file, args.block_seconds):
+        sr = 44100
+        try:
+            onset_env, duration = compute_onset_env_streamed(
+                args.audio_file,
+                sr,
+                args.hop_length,
+                use_percussion=args.percussion,
+                use_gpu=args.gpu,
+                block_seconds=args.block_seconds,
+            )
+        except Exception as e:
+            print(f"Error loading audio: {e}", file=sys.stderr)
+            sys.exit(1)
+    else:
+        y, sr = load_audio(args.audio_file, args.cache_dir)
+        if args.percussion:
+            y = percussive_component(y)
+        onset_env = compute_onset_env(y, sr, args.hop_length, args.gpu)
+        duration = len(y) / sr
+
+    point_times, point_bpms, tempo_seed = analyze_mode_a(
+        onset_env=onset_env,
         sr=sr,
+        duration=duration,
         bpm_hint=args.bpm_hint,
-        use_percussion=args.percussion,
         tightness=args.tightness,
         hop_length=args.hop_length,
         match_window_ms=args.match_window_ms,
@@ -429,6 +917,7 @@ def main():
         offset_threshold_ms=args.offset_threshold_ms,
         drift_slope_ms_per_beat=args.drift_slope_ms_per_beat,
         bpm_min_change=args.bpm_min_change,
+        detect_offbeats=not args.no_offbeat,
         phase_divisions=args.phase_divisions,
         phase_search_seconds=args.phase_search_seconds,
         min_gap_ms=args.min_gap_ms,
@@ -436,9 +925,9 @@ def main():
     )
 
     if args.json:
-        txt = format_json(points, args.average, tempo_seed)
+        txt = format_json(point_times, point_bpms, args.average, tempo_seed)
     else:
-        txt = format_text(points, args.average, tempo_seed)
+        txt = format_text(point_times, point_bpms, args.average, tempo_seed)
 
     if args.output:
         try:
@@ -4,7 +4,7 @@
 # a Squirrel.Windows installer package.
 #
 # For bpm.exe: PyInstaller automatically detects dependencies from bpm.py imports.
-# Only librosa, numpy, and scipy are needed (see requirements-bpm.txt).
+# Only librosa, numba, numpy, scipy, soundfile, and soxr are needed (see requirements-bpm.txt).
 # The script excludes common unnecessary modules to keep the executable size small.
 
 param(